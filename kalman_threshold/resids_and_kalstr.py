@@ -1,34 +1,53 @@
 import numpy as np
+import numexpr
 
-from mica.quaternion import Quat, normalize
+from mica.quaternion import normalize
 from Ska.quatutil import radec2eci
 from Chandra.Time import DateTime
 import agasc
 from Ska.engarchive import fetch
 
 
+BASE_MSIDS = ('AOACASEQ', 'AOPCADMD', 'AOKALSTR',  'COTLRDSF', 'COBSRQID',
+              'AOATTQT1', 'AOATTQT2', 'AOATTQT3', 'AOATTQT4', 'CORADMEN', '3TSCPOS', '3TSCMOVE')
+RES_MSIDS = ('AORESY0', 'AORESY1_1', 'AORESY2_1', 'AORESY3', 'AORESY4',
+             'AORESY5_1', 'AORESY6_1', 'AORESY7',
+             'AORESZ0', 'AORESZ1_1',
+             'AORESZ2_1', 'AORESZ3', 'AORESZ4', 'AORESZ5_1', 'AORESZ6_1',
+             'AORESZ7')
+SLOT_COLS = ('AOACFID', 'AOACMAG', 'AOACYAN', 'AOACZAN', 'AOACFCT', 'AOIMAGE',
+             'AOACIDP', 'AOACIIR', 'AOACIMS', 'AOACISP')
+SLOT_MSIDS = tuple("{}{}".format(field, slot) for field in SLOT_COLS
+                   for slot in range(0, 8))
+# full MSID lists keyed by (fetch residuals, after 2015:251 with AOACIMSS)
+TELEM_MSIDS = {(True, False): BASE_MSIDS + RES_MSIDS + SLOT_MSIDS,
+               (True, True): BASE_MSIDS + RES_MSIDS + SLOT_MSIDS + ('AOACIMSS',),
+               (False, False): BASE_MSIDS + SLOT_MSIDS,
+               (False, True): BASE_MSIDS + SLOT_MSIDS + ('AOACIMSS',)}
+
+
+# Quat(q).transform.T . ecis without the matrices: v' = v + s t + u x t with
+# t = 2 u x v and (u, s) the conjugate quaternion
+def quat_rotate(q, ecis):
+    ux = -q[:, 0, np.newaxis]
+    uy = -q[:, 1, np.newaxis]
+    uz = -q[:, 2, np.newaxis]
+    s = q[:, 3, np.newaxis]
+    ex, ey, ez = ecis
+    tx = 2 * (uy * ez - uz * ey)
+    ty = 2 * (uz * ex - ux * ez)
+    tz = 2 * (ux * ey - uy * ex)
+    return (ex + s * tx + (uy * tz - uz * ty),
+            ey + s * ty + (uz * tx - ux * tz),
+            ez + s * tz + (ux * ty - uy * tx))
+
+
 def get_telem(dwell):
     subformat = fetch.Msid('COTLRDSF', dwell.start, dwell.stop)
-    msids = ['AOACASEQ', 'AOPCADMD', 'AOKALSTR',  'COTLRDSF', 'COBSRQID',
-             'AOATTQT1', 'AOATTQT2', 'AOATTQT3', 'AOATTQT4', 'CORADMEN', '3TSCPOS', '3TSCMOVE']
     # don't bother getting the residuals if the dwell has PCAD subformat
-    if not np.any(subformat.vals == 'PCAD'):
-        res_msids = ['AORESY0', 'AORESY1_1', 'AORESY2_1', 'AORESY3', 'AORESY4',
-                     'AORESY5_1', 'AORESY6_1', 'AORESY7',
-                     'AORESZ0', 'AORESZ1_1',
-                     'AORESZ2_1', 'AORESZ3', 'AORESZ4', 'AORESZ5_1', 'AORESZ6_1',
-                     'AORESZ7']
-        msids = msids + res_msids
-    slot_cols = ['AOACFID', 'AOACMAG', 'AOACYAN', 'AOACZAN', 'AOACFCT', 'AOIMAGE',
-                 'AOACIDP', 'AOACIIR', 'AOACIMS', 'AOACISP']
-    slots = range(0, 8)
-    slot_msids = ["{}{}".format(field, slot) for field in slot_cols
-                  for slot in slots]
-    msids = msids + slot_msids
-    if dwell.start > '2015:251':
-        pcad_data = fetch.Msidset(msids + ['AOACIMSS'], start=dwell.start, stop=dwell.stop)
-    else:
-        pcad_data = fetch.Msidset(msids, start=dwell.start, stop=dwell.stop)
+    get_res = not np.any(subformat.vals == 'PCAD')
+    msids = TELEM_MSIDS[get_res, dwell.start > '2015:251']
+    pcad_data = fetch.Msidset(msids, start=dwell.start, stop=dwell.stop)
 
     if 'AORESY0' in pcad_data:
         for slot in [1, 2, 5, 6]:
@@ -38,68 +57,86 @@ def get_telem(dwell):
     return pcad_data
 
 
+# per-sample byte of slot MSID == val, slot 0 in the high bit as np.packbits
+def slot_flags(telem, fmt, val):
+    flags = np.zeros(len(telem[fmt.format(0)].vals), dtype=np.uint8)
+    for slot in range(0, 8):
+        flags |= (telem[fmt.format(slot)].vals == val) * np.uint8(0x80 >> slot)
+    return flags
+
+
 def kal(dwell, telem, limit=20, catalog=None, nowflags=False):
 
     cat = catalog
 
     # Track status
-    fids = np.column_stack([(telem['AOACFID{}'.format(slot)].vals == 'FID ')
-                            for slot in range(0, 8)])
-    trak = np.column_stack([(telem['AOACFCT{}'.format(slot)].vals == 'TRAK')
-                            for slot in range(0, 8)])
+    fids = slot_flags(telem, 'AOACFID{}', 'FID ')
+    trak = slot_flags(telem, 'AOACFCT{}', 'TRAK')
     # Flags
-    ir = np.column_stack([(telem['AOACIIR{}'.format(slot)].vals == 'OK ')
-                          for slot in range(0, 8)])
-    sp = np.column_stack([(telem['AOACISP{}'.format(slot)].vals == 'OK ')
-                          for slot in range(0, 8)])
+    ir = slot_flags(telem, 'AOACIIR{}', 'OK ')
+    sp = slot_flags(telem, 'AOACISP{}', 'OK ')
     dp_date = DateTime('2013:297:11:25:52.000').secs
-    dp = np.column_stack([((telem['AOACIDP{}'.format(slot)].vals == 'OK ')
-                           | (telem['AOKALSTR'].times > dp_date))
-                          for slot in range(0, 8)])
+    dp = slot_flags(telem, 'AOACIDP{}', 'OK ')
+    dp[telem['AOKALSTR'].times > dp_date] = 0xFF
+    ms = slot_flags(telem, 'AOACIMS{}', 'OK ')
     if dwell.start > '2015:251':
-        # I'm not sure about the fetch grid if we use fetch interpolate, so just use
-        # a sorted search to see if the MSS flag should apply
         mss = telem['AOACIMSS'].vals == 'ENAB'
         mss_times = telem['AOACIMSS'].times
-        mss_at_times = mss[np.searchsorted(mss_times[1:-1], telem['AOACIMS0'].times) - 1]
-        ms = np.column_stack([((telem['AOACIMS{}'.format(slot)].vals == 'OK ')
-                               | ~mss_at_times)
-                              for slot in range(0, 8)])
-    else:
-        ms = np.column_stack([(telem['AOACIMS{}'.format(slot)].vals == 'OK ')
-                              for slot in range(0, 8)])
-
-    # use rolled-by-4 for ~last 4.1 sample
-    last_trak = np.roll(trak, 4, axis=0)
-    last_trak[0] = True
+        ms_times = telem['AOACIMS0'].times
+        if len(mss_times) == len(ms_times) and mss_times[0] == ms_times[0]:
+            # same sample grid, so the flag already lines up
+            mss_at_times = mss
+        elif np.all(mss == mss[0]):
+            # no MSS change in the dwell, so just expand the one value
+            mss_at_times = np.repeat(mss[:1], len(ms_times))
+        else:
+            # I'm not sure about the fetch grid if we use fetch interpolate, so just use
+            # a sorted search to see if the MSS flag should apply
+            mss_at_times = mss[np.searchsorted(mss_times[1:-1], ms_times) - 1]
+        ms[~mss_at_times] = 0xFF
+
+    # use shifted-by-4 for ~last 4.1 sample
+    last_trak = np.empty_like(trak)
+    last_trak[:4] = 0xFF
+    last_trak[4:] = trak[:-4]
 
     # Calc centroid residuals using CYAN/CZAN
-    q_atts = Quat(normalize(np.column_stack([telem['AOATTQT1'].vals,
-                                             telem['AOATTQT2'].vals,
-                                             telem['AOATTQT3'].vals,
-                                             telem['AOATTQT4'].vals])))
+    # float32 (with the ecis cast below) is well within the 5 arcsec limit
+    q_atts = normalize(np.column_stack([telem['AOATTQT1'].vals,
+                                        telem['AOATTQT2'].vals,
+                                        telem['AOATTQT3'].vals,
+                                        telem['AOATTQT4'].vals]).astype(np.float32))
 
     # guide and bot slots
     gcat = cat[(cat['type'] == 'BOT') | (cat['type'] == 'GUI')]
-    # make a couple of structures for the offsets
-    yag_offs = np.zeros((len(telem['AOKALSTR'].vals), 8))
-    zag_offs = np.zeros((len(telem['AOKALSTR'].vals), 8))
-    for idx, entry in enumerate(gcat):
-        slot = entry['slot']
-        #ok = telem['AOACFCT{}'.format(slot)].vals == 'TRAK'
-        star = agasc.get_star(entry['id'], date=dwell.manvr.start)
-        eci = radec2eci(star['RA_PMCORR'], star['DEC_PMCORR'])
-        d_aca = np.dot(q_atts.transform.transpose(0,2,1), eci)
-        yag = np.degrees(np.arctan2(d_aca[:, 1], d_aca[:, 0])) * 3600
-        zag = np.degrees(np.arctan2(d_aca[:, 2], d_aca[:, 0])) * 3600
-        yag_offs[:, slot] = yag - telem['AOACYAN{}'.format(entry['slot'])].vals
-        zag_offs[:, slot] = zag - telem['AOACZAN{}'.format(entry['slot'])].vals
-
-    if nowflags:
-        kal = (~fids & trak & last_trak & ir & sp
-                & (np.abs(yag_offs) < limit) & (np.abs(zag_offs) < limit))
-    else:
-        kal = (~fids & trak & last_trak & ir & sp & dp & ms
-                & (np.abs(yag_offs) < limit) & (np.abs(zag_offs) < limit))
+    # slots without a guide star have no offset to check, so they always pass
+    offs_ok = np.full(len(telem['AOKALSTR'].vals), 0xFF, dtype=np.uint8)
+    if len(gcat):
+        slots = [entry['slot'] for entry in gcat]
+        ecis = []
+        for entry in gcat:
+            star = agasc.get_star(entry['id'], date=dwell.manvr.start)
+            ecis.append(radec2eci(star['RA_PMCORR'], star['DEC_PMCORR']))
+        # rotate all the stars at once into (T, n_stars) ACA frame components
+        d0, d1, d2 = quat_rotate(q_atts, np.column_stack(ecis).astype(np.float32))
+        # (T, n_stars) offsets for just the guide slots, in place in the d1/d2 buffers
+        yag_offs = np.arctan2(d1, d0, out=d1)
+        np.degrees(yag_offs, out=yag_offs)
+        yag_offs *= 3600
+        yag_offs -= np.column_stack([telem['AOACYAN{}'.format(slot)].vals for slot in slots])
+        zag_offs = np.arctan2(d2, d0, out=d2)
+        np.degrees(zag_offs, out=zag_offs)
+        zag_offs *= 3600
+        zag_offs -= np.column_stack([telem['AOACZAN{}'.format(slot)].vals for slot in slots])
+        # offsets check in one fused pass, then clear the bits of the failing slots
+        ok = numexpr.evaluate("(abs(yag_offs) < limit) & (abs(zag_offs) < limit)")
+        for idx, slot in enumerate(slots):
+            offs_ok[~ok[:, idx]] &= np.uint8(0xFF ^ (0x80 >> slot))
+
+    # all slot flags are packed one byte per sample, so the mask is 8 slots per AND
+    kal = ~fids & trak & last_trak & ir & sp & offs_ok
+    if not nowflags:
+        kal &= dp & ms
+    kal = np.unpackbits(kal[:, np.newaxis], axis=1).view(bool)
 
     return telem['AOKALSTR'].times, kal
@@ -1,17 +1,57 @@
 from kadi import events
-from mica.quaternion import Quat, normalize
+from mica.quaternion import normalize
 from mica.starcheck import get_starcheck_catalog
 import os
+import glob
 import time
 import re
+import math
 from Chandra.Time import DateTime
 import Ska.DBI
-from Ska.Shell import bash
 from astropy.table import Table
 import numpy as np
+import numba
+from joblib import Parallel, delayed
 from Ska.engarchive import fetch
 
 MP_DIR = '/data/mpcrit1/mplogs'
+SLOT_COLS = ('AOACMAG', 'AOACYAN', 'AOACZAN', 'AOACFCT', 'AOIMAGE',
+             'AOACIDP', 'AOACIIR', 'AOACIMS', 'AOACISP')
+PCAD_MSIDS = (('AOACASEQ', 'AOPCADMD', 'AOKALSTR', 'AONSTARS',
+               'AOATTQT1', 'AOATTQT2', 'AOATTQT3', 'AOATTQT4', 'AOACIMSS')
+              + tuple("{}{}".format(field, slot) for field in SLOT_COLS
+                      for slot in range(0, 8)))
+
+
+# one alternation per .sum section, with a named group for each field, so
+# that a section paragraph is scanned once instead of once per field
+CONT_FIELDS_RE = re.compile(
+    r"Run\sDirectory:\s\S+\/(?P<replan_cmds>C\d{3}:\d{4})"
+    r"|Continuity\sDirectory:\s\S+\/(?P<continuity_cmds>C\d{3}:\d{4})")
+PROCESSING_FIELDS_RE = re.compile(
+    r"EXECUTION\sBEGIN\sTIME:(?P<execution_tstart>\S+)"
+    r"|START\sTIME:\s+(?P<processing_tstart>\S+)"
+    r"|STOP\sTIME:\s+(?P<processing_tstop>\S+)")
+BCF_FIELDS_RE = re.compile(
+    r"TOTAL\sNUMBER\sOF\sCOMMANDS\sREAD\s=\s(?P<bcf_cmd_count>\d+)")
+ACTUAL_FIELDS_RE = re.compile(
+    r"ACTUAL\sSTART\sTIME:\s(?P<planning_tstart>\S+)"
+    r"|ACTUAL\sSTOP\s\sTIME:\s(?P<planning_tstop>\S+)")
+LOAD_FIELDS_RE = re.compile(
+    r"Load\sname:\s+(?P<load_segment>CL\d{3}:\d{4})"
+    r"|SCS\sNumber:\s+(?P<load_scs>\d{3}(?:\s*\/\s*\d{3})?)"
+    r"|First\sCommand\sTime:\s+(?P<first_cmd_time>\S+)"
+    r"|Last\sCommand\sTime:\s+(?P<last_cmd_time>\S+)")
+RE_SCS_PAIR = re.compile(r"^(\d{3})\s*\/\s*(\d{3})$")
+
+
+# first value of each named field, in one pass over the paragraph
+def scan_fields(pattern, piece):
+    fields = {}
+    for match in pattern.finditer(piece):
+        if match.lastgroup not in fields:
+            fields[match.lastgroup] = match.group(match.lastgroup)
+    return fields
 
 
 def parse_clgps(file):
@@ -27,63 +67,36 @@ def parse_clgps(file):
     # split the file into paragraphs based on the asterisk separator lines
     chunks = open(file).read().split("\n************")
 
-    # do the yucky, but maintainable, regex parsing of each paragraph
+    # use plain substring checks to find the section of each paragraph, then
+    # pull out all of that section's fields in one scan
     for piece in chunks:
-        if re.search("CONTINUITY/REPLAN", piece):
-            if re.search("Replan/Reopen", piece):
+        if "CONTINUITY/REPLAN" in piece:
+            fields = scan_fields(CONT_FIELDS_RE, piece)
+            if "Replan/Reopen" in piece:
                 summary['replan'] = True
-                run_dir = re.search("Run\sDirectory:\s\S+\/(C\d{3}:\d{4})", piece)
-                if run_dir:
-                    summary['replan_cmds'] = run_dir.group(1)
-                cont_dir = re.search("Continuity\sDirectory:\s\S+\/(C\d{3}:\d{4})", piece)
-                if cont_dir:
-                    summary['continuity_cmds'] = cont_dir.group(1)
             else:
-                cont_dir = re.search("Continuity\sDirectory:\s\S+\/(C\d{3}:\d{4})", piece)
-                if cont_dir:
-                    summary['continuity_cmds'] = cont_dir.group(1)
-        if re.search("\*+PROCESSING\sVALUES\*+", piece):
-            exec_time = re.search("EXECUTION\sBEGIN\sTIME:(\S+)", piece)
-            if exec_time:
-                summary['execution_tstart'] = exec_time.group(1)
-            proc_start = re.search("START\sTIME:\s+(\S+)", piece)
-            if proc_start:
-                summary['processing_tstart'] = proc_start.group(1)
-            proc_stop = re.search("STOP\sTIME:\s+(\S+)", piece)
-            if proc_stop:
-                summary['processing_tstop'] = proc_stop.group(1)
-        if re.search("\*+\sINPUT\sREPLAN\sBCF\sINFORMATION\s\*+", piece):
-            bcf = re.search("TOTAL\sNUMBER\sOF\sCOMMANDS\sREAD\s=\s(\d+)", piece)
-            if bcf:
-                summary['bcf_cmd_count'] = int(bcf.group(1))
-        if re.search("\*+\sACTUAL\sPLANNING\sPERIOD\sSTART\/STOP\sTIMES\s\*+", piece):
-            actual_start = re.search("ACTUAL\sSTART\sTIME:\s(\S+)", piece)
-            if actual_start:
-                summary['planning_tstart'] = actual_start.group(1)
-                summary['year'] = int(summary['planning_tstart'][0:4])
-            actual_stop = re.search("ACTUAL\sSTOP\s\sTIME:\s(\S+)", piece)
-            if actual_stop:
-                summary['planning_tstop'] = actual_stop.group(1)
-        if re.search("\*+LOAD\sGENERATED\*+", piece):
-            load = {}
-            load_seg = re.search("Load\sname:\s+(CL\d{3}:\d{4})", piece)
-            if load_seg:
-                load['load_segment'] = load_seg.group(1)
-            scs = re.search("SCS\sNumber:\s+(\d{3}(\s*\/\s*\d{3})?)", piece)
-            if scs:
-                load['load_scs'] = scs.group(1)
-            first_cmd = re.search("First\sCommand\sTime:\s+(\S+)", piece)
-            if first_cmd:
-                load['first_cmd_time'] = first_cmd.group(1)
+                fields.pop('replan_cmds', None)
+            summary.update(fields)
+        if "PROCESSING VALUES" in piece:
+            summary.update(scan_fields(PROCESSING_FIELDS_RE, piece))
+        if "INPUT REPLAN BCF INFORMATION" in piece:
+            fields = scan_fields(BCF_FIELDS_RE, piece)
+            if 'bcf_cmd_count' in fields:
+                summary['bcf_cmd_count'] = int(fields['bcf_cmd_count'])
+        if "ACTUAL PLANNING PERIOD START/STOP TIMES" in piece:
+            fields = scan_fields(ACTUAL_FIELDS_RE, piece)
+            if 'planning_tstart' in fields:
+                fields['year'] = int(fields['planning_tstart'][0:4])
+            summary.update(fields)
+        if "LOAD GENERATED" in piece:
+            load = scan_fields(LOAD_FIELDS_RE, piece)
+            if 'first_cmd_time' in load:
                 load['year'] = int(load['first_cmd_time'][0:4])
-            last_cmd = re.search("Last\sCommand\sTime:\s+(\S+)", piece)
-            if last_cmd:
-                load['last_cmd_time'] = last_cmd.group(1)
             rawloads.append(load)
 
     loads = []
     for rawload in rawloads:
-        scs_pat = re.match("^(\d{3})\s*\/\s*(\d{3})$", rawload['load_scs'])
+        scs_pat = RE_SCS_PAIR.match(rawload['load_scs'])
         if scs_pat:
             vehicle_scs = scs_pat.group(1)
             observing_scs = scs_pat.group(2)
@@ -106,12 +119,10 @@ def get_loads():
 
     files = []
     for year in range(2008, int(now.frac_year) + 1):
-        cmd = ("find -L {mp_dir}/{year:04d}/{week_glob}/ofls?/mps/ ".format(mp_dir=MP_DIR, year=year, week_glob=week_glob)
-               + ' -maxdepth 1 -wholename \"*/ofls?/mps/{sum_glob}\" '.format(sum_glob=sum_glob))
-        files.extend(bash(cmd))
+        files.extend(glob.glob("{mp_dir}/{year:04d}/{week_glob}/ofls?/mps/{sum_glob}".format(
+                    mp_dir=MP_DIR, year=year, week_glob=week_glob, sum_glob=sum_glob)))
 
-    summaries = []
-    loads = []
+    names = []
     for filename in files:
         name = re.match(MP_DIR + "/(((\d{4})/(\w{3}\d{4})/ofls(\w))/mps/(C.*\.sum))",
                         filename)
@@ -119,7 +130,15 @@ def get_loads():
             continue
         if name and name.groups(4) == 'x' or name.groups(4) == 't':
             continue
-        summary, week_loads = parse_clgps(filename)
+        names.append(name)
+
+    # the files are parsed independently, so spread them over all the cores
+    parsed = Parallel(n_jobs=-1, backend='loky', batch_size=32)(
+        delayed(parse_clgps)(name.string) for name in names)
+
+    summaries = []
+    loads = []
+    for name, (summary, week_loads) in zip(names, parsed):
         summary['file'] = name.group(1)
         summary['shortfile'] = name.group(6)
         summary['mp_dir'] = name.group(2)
@@ -179,16 +198,38 @@ def get_catalog(obsid, obstime):
     return cat
 
 
+# number of guide stars per sample with a yag or zag offset between lim_lo and lim_hi
+@numba.njit(parallel=True, cache=True)
+def score_dwell(q, ecis, yans, zans, lim_lo, lim_hi):
+    n_times = q.shape[0]
+    n_stars = ecis.shape[1]
+    diff = np.zeros(n_times, dtype=np.int32)
+    for i in numba.prange(n_times):
+        ux = -q[i, 0]
+        uy = -q[i, 1]
+        uz = -q[i, 2]
+        s = q[i, 3]
+        for k in range(n_stars):
+            # same rotation as quat_rotate in ../resids_and_kalstr.py
+            ex = ecis[0, k]
+            ey = ecis[1, k]
+            ez = ecis[2, k]
+            tx = 2 * (uy * ez - uz * ey)
+            ty = 2 * (uz * ex - ux * ez)
+            tz = 2 * (ux * ey - uy * ex)
+            d0 = ex + s * tx + (uy * tz - uz * ty)
+            d1 = ey + s * ty + (uz * tx - ux * tz)
+            d2 = ez + s * tz + (ux * ty - uy * tx)
+            yag_off = abs(math.degrees(math.atan2(d1, d0)) * 3600 - yans[i, k])
+            zag_off = abs(math.degrees(math.atan2(d2, d0)) * 3600 - zans[i, k])
+            if ((yag_off > lim_lo and yag_off < lim_hi)
+                    or (zag_off > lim_lo and zag_off < lim_hi)):
+                diff[i] += 1
+    return diff
+
+
 def get_pcad(dwell):
-    msids = ['AOACASEQ', 'AOPCADMD', 'AOKALSTR', 'AONSTARS',
-             'AOATTQT1', 'AOATTQT2', 'AOATTQT3', 'AOATTQT4', 'AOACIMSS']
-    slots = range(0, 8)
-    slot_cols = ['AOACMAG', 'AOACYAN', 'AOACZAN', 'AOACFCT', 'AOIMAGE',
-                 'AOACIDP', 'AOACIIR', 'AOACIMS', 'AOACISP']
-    slot_msids = ["{}{}".format(field, slot) for field in slot_cols
-                  for slot in slots]
-    msids.extend(slot_msids)
-    return fetch.MSIDset(msids, dwell.start, dwell.stop)
+    return fetch.MSIDset(PCAD_MSIDS, dwell.start, dwell.stop)
 
 
 if 'loads' not in globals():
@@ -200,11 +241,35 @@ if 'load_segments' not in globals():
 import agasc
 from Ska.quatutil import radec2eci
 
+# star ECI vectors keyed by (agasc id, day); kept across re-runs like loads
+if 'star_ecis' not in globals():
+    star_ecis = {}
+
+
+# proper motion within a day is far below the residual limits
+def get_star_eci(star_id, date):
+    key = (star_id, date[0:8])
+    if key not in star_ecis:
+        star = agasc.get_star(star_id, date=key[1])
+        star_ecis[key] = radec2eci(star['RA_PMCORR'], star['DEC_PMCORR'])
+    return star_ecis[key]
+
 orig_bad_obsids = []
 bad_obsids = []
 
-def consecutive(data, stepsize=1):
-        return np.split(data, np.where(np.diff(data) != stepsize)[0] + 1)
+@numba.njit(cache=True)
+def find_low_runs(kalstr, diff, min_len):
+    # start indices of runs longer than min_len with kalstr - diff < 3 and diff != 0
+    starts = []
+    run_len = 0
+    for i in range(len(kalstr) + 1):
+        if i < len(kalstr) and (kalstr[i] - diff[i]) < 3 and diff[i] != 0:
+            run_len += 1
+        else:
+            if run_len > min_len:
+                starts.append(i - run_len)
+            run_len = 0
+    return starts
 
 ds = events.dwells.filter(start='2008:007')
 #ds = events.dwells.filter(obsid=17321)
@@ -213,36 +278,27 @@ for d in ds:
     obsid = d.get_obsid()
     print "obsid {} start {}".format(obsid, d.manvr.start)
     pcad_data = get_pcad(d)
-    q_atts = Quat(normalize(np.column_stack([pcad_data['AOATTQT1'].vals,
-                                             pcad_data['AOATTQT2'].vals,
-                                             pcad_data['AOATTQT3'].vals,
-                                             pcad_data['AOATTQT4'].vals])))
+    q_atts = normalize(np.column_stack([pcad_data['AOATTQT1'].vals,
+                                        pcad_data['AOATTQT2'].vals,
+                                        pcad_data['AOATTQT3'].vals,
+                                        pcad_data['AOATTQT4'].vals]))
     try:
         cat = get_catalog(obsid, d.manvr.start)
     except (ValueError, IndexError) as e:
         print "Skipping {} {}".format(obsid, e)
         continue
     gcat = cat['cat'][(cat['cat']['type'] == 'BOT') | (cat['cat']['type'] == 'GUI')]
-    yag_offs = np.zeros((len(pcad_data['AOKALSTR'].vals), len(gcat)))
-    zag_offs = np.zeros((len(pcad_data['AOKALSTR'].vals), len(gcat)))
-    slot_ok_old = {}
-    slot_ok_new = {}
-    for idx, entry in enumerate(gcat):
-        slot = entry['slot']
-        #ok = pcad_data['AOACFCT{}'.format(slot)].vals == 'TRAK'
-        star = agasc.get_star(entry['id'], date=d.manvr.start)
-        eci = radec2eci(star['RA_PMCORR'], star['DEC_PMCORR'])
-        d_aca = np.dot(q_atts.transform.transpose(0,2,1), eci)
-        yag = np.degrees(np.arctan2(d_aca[:, 1], d_aca[:, 0])) * 3600
-        zag = np.degrees(np.arctan2(d_aca[:, 2], d_aca[:, 0])) * 3600
-        yag_offs[:, idx] = yag - pcad_data['AOACYAN{}'.format(entry['slot'])].vals
-        zag_offs[:, idx] = zag - pcad_data['AOACZAN{}'.format(entry['slot'])].vals
-    diff = np.sum(((np.abs(yag_offs) > 5) & (np.abs(yag_offs) < 20))
-                  | ((np.abs(zag_offs) > 5) & (np.abs(zag_offs) < 20)), axis=1)
+    # number of stars per sample with a 5 to 20 arcsec offset
+    diff = np.zeros(len(pcad_data['AOKALSTR'].vals), dtype=np.int32)
+    if len(gcat):
+        ecis = np.column_stack([get_star_eci(entry['id'], d.manvr.start) for entry in gcat])
+        yans = np.column_stack(
+            [pcad_data['AOACYAN{}'.format(entry['slot'])].vals for entry in gcat])
+        zans = np.column_stack(
+            [pcad_data['AOACZAN{}'.format(entry['slot'])].vals for entry in gcat])
+        diff = score_dwell(q_atts, ecis, yans, zans, 5, 20)
     kalstr = pcad_data['AOKALSTR'].vals.astype(int)
-    for e in consecutive(np.flatnonzero(((kalstr - diff) < 3) & (diff != 0))):
-        if len(e) > 8:
-            low_obsids.append(obsid)
+    low_obsids.extend([obsid] * len(find_low_runs(kalstr, diff, 8)))
 
 low_obsids = np.unique(low_obsids)
 
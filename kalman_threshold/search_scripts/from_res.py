@@ -1,6 +1,7 @@
 import numpy as np
+import numba
+from joblib import Parallel, delayed
 from astropy.table import Table
-import mica.quaternion
 from Ska.quatutil import radec2eci
 import agasc
 from kadi import events
@@ -27,17 +28,23 @@ slot_msids = ["{}{}".format(field, slot) for field in slot_cols
                   for slot in slots]
 
 
-def consecutive(data, stepsize=1):
-        return np.split(data, np.where(np.diff(data) != stepsize)[0] + 1)
+@numba.njit(cache=True)
+def find_low_runs(kalstr, diff, min_len):
+    # start indices of runs longer than min_len with kalstr - diff < 3 and diff != 0
+    starts = []
+    run_len = 0
+    for i in range(len(kalstr) + 1):
+        if i < len(kalstr) and (kalstr[i] - diff[i]) < 3 and diff[i] != 0:
+            run_len += 1
+        else:
+            if run_len > min_len:
+                starts.append(i - run_len)
+            run_len = 0
+    return starts
 
-low_t = []
-chunk = 30
-for day_back in range(-3282, 0, chunk):
-    start = DateTime(day_back)
-    if (day_back + chunk) < 0:
-        stop = DateTime(day_back + chunk)
-    else:
-        continue
+
+# start dates of the long low-kalstr intervals between start and stop
+def process_chunk(start, stop):
     telem = fetch.get_telem(['AOKALSTR'] + res_msids, start=start, stop=stop,
                             select_events='dwells')
     telem.interpolate(4.1)
@@ -45,20 +52,32 @@ for day_back in range(-3282, 0, chunk):
         telem['AORESY{}'.format(slot)] = telem['AORESY{}_1'.format(slot)]
         telem['AORESZ{}'.format(slot)] = telem['AORESZ{}_1'.format(slot)]
 
-    yres_ok =  np.column_stack([np.abs(np.degrees(telem['AORESY{}'.format(slot)].vals)) * 3600 < 20
-                                for slot in range(0, 8)])
-    zres_ok =  np.column_stack([np.abs(np.degrees(telem['AORESY{}'.format(slot)].vals)) * 3600 < 20
-                             for slot in range(0, 8)])
-    yres_great =  np.column_stack([np.abs(np.degrees(telem['AORESY{}'.format(slot)].vals)) * 3600 < 5
-                             for slot in range(0, 8)])
-    zres_great =  np.column_stack([np.abs(np.degrees(telem['AORESY{}'.format(slot)].vals)) * 3600 < 5
-                                   for slot in range(0, 8)])
+    # residuals in arcsec as (T, 8) arrays, converted in place
+    res_y = np.column_stack([telem['AORESY{}'.format(slot)].vals for slot in range(0, 8)])
+    res_z = np.column_stack([telem['AORESZ{}'.format(slot)].vals for slot in range(0, 8)])
+    abs_y = np.abs(np.degrees(res_y, out=res_y), out=res_y)
+    abs_y *= 3600
+    abs_z = np.abs(np.degrees(res_z, out=res_z), out=res_z)
+    abs_z *= 3600
+    yres_ok = abs_y < 20
+    zres_ok = abs_z < 20
+    yres_great = abs_y < 5
+    zres_great = abs_z < 5
 
     kalstr = telem['AOKALSTR'].vals.astype(int)
-    diff = np.sum((yres_ok != yres_great) | (zres_ok != zres_great), axis=1)
+    diff = np.sum((yres_ok ^ yres_great) | (zres_ok ^ zres_great), axis=1)
     # find the intervals (with good onboard residual data) where the nonzero
     # diff and low kalstr could have caused a problem.
-    for e in consecutive(np.flatnonzero(((kalstr - diff) < 3) & (diff != 0))):
-        if len(e) > 8:
-            low_t.append(DateTime(telem['AORESY0'].times[e[0]]).date)
+    return [DateTime(telem['AORESY0'].times[idx]).date
+            for idx in find_low_runs(kalstr, diff, 8)]
 
+
+# Bigger chunks amortize the fetch and interpolate setup; each chunk is
+# independent so they are processed in parallel.
+chunk = 120
+chunk_bounds = []
+for day_back in range(-3282, 0, chunk):
+    chunk_bounds.append((DateTime(day_back).date, DateTime(min(day_back + chunk, 0)).date))
+low_t = [t for chunk_low_t in Parallel(n_jobs=8)(delayed(process_chunk)(start, stop)
+                                                  for start, stop in chunk_bounds)
+         for t in chunk_low_t]
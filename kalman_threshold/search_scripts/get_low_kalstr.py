@@ -1,5 +1,4 @@
 from kadi import events
-from mica.quaternion import Quat, normalize
 from mica.starcheck import get_starcheck_catalog
 import os
 import time
@@ -11,16 +10,20 @@ from astropy.table import Table
 import numpy as np
 from Ska.engarchive import fetch
 
+dat = fetch.Msid('AOKALSTR', '2008:001', '2017:001')
+lowkals = dat.logical_intervals('<=', '2 ')
+# too-long intervals are spurious
+lowkals = lowkals[(lowkals['duration'] > 60) & (lowkals['duration'] < 120)]
+
+# find the dwells overlapping each interval with sorted searches on the dwell times
+dwells = list(events.dwells.filter(start='2008:001', stop='2017:001'))
+dwell_tstarts = np.array([d.tstart for d in dwells])
+dwell_tstops = np.array([d.tstop for d in dwells])
+firsts = np.searchsorted(dwell_tstops, lowkals['tstart'], side='right')
+lasts = np.searchsorted(dwell_tstarts, lowkals['tstop'])
 kalstr_obsids = []
-for year in range(2008, 2017):
-    dat = fetch.Msid('AOKALSTR', '{}:001'.format(year), '{}:001'.format(year+1))
-    lowkals = dat.logical_intervals('<=', '2 ')
-    lowkals = lowkals[lowkals['duration'] < 120]  # too-long intervals are spurious
-    bad = lowkals['duration'] > 60
-    lowkals = lowkals[bad]
-    for interval in lowkals:
-        ds = events.dwells.filter(start=interval['tstart'], stop=interval['tstop'])
-        kalstr_obsids.extend([d.get_obsid() for d in ds])
+for first, last in zip(firsts, lasts):
+    kalstr_obsids.extend([d.get_obsid() for d in dwells[first:last]])
 
 kalstr_obsids = np.unique(kalstr_obsids)
 kalstr_obsids = kalstr_obsids[kalstr_obsids != 0]